@@ -136,12 +136,14 @@ def draw_texts(fonts, line, writer, xlist):
     current_font_name = None
     for x, font_name, text in xlist:
         if font_name != current_font_name:
+            if current_font_name is not None:
+                writer.end_line()
             font = fonts[font_name]
-            writer.set_font(font)
+            writer.begin_line(line.column.y + line.y - font.descent, font)
             current_font_name = font_name
-        writer.draw_text(line.column.x + x,
-                        line.column.y + line.y - font.descent,
-                        text)
+        writer.add_glyph(line.column.x + x, text)
+    if current_font_name is not None:
+        writer.end_line()
 
 
 if __name__ == '__main__':
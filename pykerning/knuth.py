@@ -42,7 +42,9 @@ def knuth_paragraph(actions, a, fonts, line, next_line,
     for font_name, text in fonts_and_texts:
         font = fonts[font_name]
         width_of = font.width_of
-        boxes = break_text_into_boxes(text, font_name, width_of, space_glue)
+        measure = _range_measure(font, text)
+        boxes = break_text_into_boxes(text, font_name, width_of, space_glue,
+                                      measure)
         olist.extend(boxes)
 
     if olist[-1] is space_glue:
@@ -98,11 +100,29 @@ def knuth_paragraph(actions, a, fonts, line, next_line,
 # and runs of contiguous space.  If it works correctly, any possible
 # string will consist entirely of contiguous matches of this regular
 # expression.
-_text_findall = re.compile(r'([\u00a0]?)(\w*)([^\u00a0\w\s]*)([ \n]*)').findall
+_text_finditer = re.compile(r'([\u00a0]?)(\w*)([^\u00a0\w\s]*)([ \n]*)').finditer
 
-def break_text_into_boxes(text, font_name, width_of, space_glue):
+def _range_measure(font, text):
+    """Return a function that measures `text[start:end]` in `font`.
+
+    Fonts that offer `prepare_run()` measure the whole text once, so
+    each word is then measured by a subtraction.
+    """
+    prepare_run = getattr(font, 'prepare_run', None)
+    if prepare_run is None:
+        width_of = font.width_of
+        return lambda start, end: width_of(text[start:end])
+    run = prepare_run(text)
+    width_of_range = font.width_of_range
+    return lambda start, end: width_of_range(run, start, end)
+
+def break_text_into_boxes(text, font_name, width_of, space_glue,
+                          measure=None):
     #print(repr(text))
-    for control_code, word, punctuation, space in _text_findall(text):
+    if measure is None:
+        measure = lambda start, end: width_of(text[start:end])
+    for match in _text_finditer(text):
+        control_code, word, punctuation, space = match.groups()
         #print((control_code, word, punctuation, space))
         if control_code:
             if control_code == '\u00a0':
@@ -114,12 +134,16 @@ def break_text_into_boxes(text, font_name, width_of, space_glue):
             strings = hyphenate_word(word)
             if punctuation:
                 strings[-1] += punctuation
+            start = match.start(2)
             for i, string in enumerate(strings):
                 if i:
                     yield Penalty(width_of('-'), 100)
-                yield Box(width_of(string), (font_name, string))
+                end = start + len(string)
+                yield Box(measure(start, end), (font_name, string))
+                start = end
         elif punctuation:
-            yield Box(width_of(punctuation), (font_name, punctuation))
+            yield Box(measure(match.start(3), match.end(3)),
+                      (font_name, punctuation))
         if punctuation == '-':
             yield _zero_width_break
         if space:
@@ -345,6 +345,12 @@ class ObjectList(list):
                     print(A.position, A.line, A.fitness_class)
                 print ; print
 
+            # Properties of the breakpoint B itself, shared by every
+            # line that ends here.
+            # TODO: eliminate one of these?
+            forced = B.is_forced_break()
+            assert forced == self.is_forced_break(i)
+
             # Loop over the list of active nodes, and compute the fitness
             # of the line formed by breaking at A and B.  The resulting
             breaks = []                 # List of feasible breaks
@@ -368,10 +374,7 @@ class ObjectList(list):
                 #             print '\tRemoving node', A
                 #         active_nodes.remove(A)
 
-                # TODO: eliminate one of these?
-                assert B.is_forced_break() == self.is_forced_break(i)
-
-                if r < -1 or B.is_forced_break():
+                if r < -1 or forced:
                     active_nodes.remove(A)
 
                 tolerable = (-1 <= r <= tolerance)
@@ -382,7 +385,7 @@ class ObjectList(list):
                 # Compute demerits and fitness class
                 if p[i] >= 0:
                     demerits = (1 + 100 * abs(r)**3 + p[i]) ** 3
-                elif self.is_forced_break(i):
+                elif forced:
                     demerits = (1 + 100 * abs(r)**3) ** 2 - p[i]**2
                 else:
                     demerits = (1 + 100 * abs(r)**3) ** 2
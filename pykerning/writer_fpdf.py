@@ -3,18 +3,34 @@
 This module provides an alternative to QtWriter that uses fpdf2 instead of PySide2.
 """
 
+import os
+import weakref
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from itertools import accumulate
+
 from fpdf import FPDF
-from pathlib import Path
+from fpdf.enums import TextMode
+from fpdf.errors import FPDFException, FPDFUnicodeEncodingException
+from fpdf.fonts import TTFFont
 
 # Unit conversion constants
 POINTS_PER_INCH = 72
 MM_PER_INCH = 25.4
+MM_PER_PT = MM_PER_INCH / POINTS_PER_INCH
 
 # Font metric ratios (typical values for matching Qt's metrics)
 FONT_ASCENT_RATIO = 0.8
 FONT_DESCENT_RATIO = 0.2
 FONT_LEADING_RATIO = 0.2
 
+# Font sizes are rounded to this many decimal places of a point, so that
+# sizes that only differ by conversion noise share fonts and width caches
+FONT_SIZE_DECIMALS = 2
+
+# Maximum number of distinct live fonts a writer keeps track of for reuse
+MAX_POOLED_FONTS = 64
+
 # Font family constants
 DEFAULT_FONT_FAMILY = "GentiumBasic"
 
@@ -24,15 +40,39 @@ STYLE_ITALIC = 'I'
 STYLE_BOLD = 'B'
 STYLE_BOLD_ITALIC = 'BI'
 
+# Style names used in font specifications, mapped to fpdf2 style codes
+STYLE_NAMES = {
+    'Regular': STYLE_REGULAR,
+    'Italic': STYLE_ITALIC,
+    'Bold': STYLE_BOLD,
+    'Bold Italic': STYLE_BOLD_ITALIC,
+}
+
+# Font file name suffixes, mapped to fpdf2 style codes
+STYLE_SUFFIXES = {
+    'BI': STYLE_BOLD_ITALIC,
+    'IB': STYLE_BOLD_ITALIC,
+    'I': STYLE_ITALIC,
+    'B': STYLE_BOLD,
+    'R': STYLE_REGULAR,
+}
+
 
 class FpdfFont:
     """Font wrapper that matches the QtFont interface."""
 
+    __slots__ = (
+        'pdf', 'font_family', 'font_style', 'font_size',
+        'height', 'ascent', 'descent', 'leading',
+        '_width_cache', '_cw', '_ascii_cw',
+        '__weakref__',
+    )
+
     def __init__(self, pdf, font_family, font_style, font_size):
         self.pdf = pdf
         self.font_family = font_family
         self.font_style = font_style
-        self.font_size = font_size
+        self.font_size = font_size = round(font_size, FONT_SIZE_DECIMALS)
 
         # Calculate font metrics
         # fpdf2 uses points, and we need to match Qt's metrics
@@ -41,31 +81,144 @@ class FpdfFont:
         self.descent = font_size * FONT_DESCENT_RATIO
         self.leading = font_size * FONT_LEADING_RATIO
 
+        # Memoized widths: text -> width in points
+        self._width_cache = {}
+        # Advance widths by code point, and of the ASCII characters alone,
+        # in thousandths of the font size; loaded on first use
+        self._cw = None
+        self._ascii_cw = None
+
     def width_of(self, text):
         """Returns the width of text in points."""
-        # Temporarily set the font to measure text
-        current_family = self.pdf.font_family
-        current_style = self.pdf.font_style
-        current_size = self.pdf.font_size_pt
+        width = self._width_cache.get(text)
+        if width is None:
+            # Same arithmetic as fpdf2, without its text processing
+            try:
+                width = sum(self._advances(text)) * self.font_size * 0.001
+            except KeyError:
+                self._check_text(text)
+                raise
+            self._width_cache[text] = width
+        return width
 
-        self.pdf.set_font(self.font_family, self.font_style, self.font_size)
-        width = self.pdf.get_string_width(text)
+    def prepare_run(self, text):
+        """Returns the cumulative widths of text, for use with width_of_range.
 
-        # Restore previous font
-        if current_family:
-            self.pdf.set_font(current_family, current_style, current_size)
+        Entry i of the returned list is the width in points of text[:i].
+        """
+        scale = self.font_size * 0.001
+        units = accumulate(self._advances(text), initial=0)
+        try:
+            return [unit * scale for unit in units]
+        except KeyError:
+            self._check_text(text)
+            raise
 
-        return width
+    def width_of_range(self, run, start, end):
+        """Returns the width of text[start:end] in points.
+
+        Args:
+            run: Cumulative widths of text, as returned by prepare_run
+            start: Index of the first character
+            end: Index after the last character
+        """
+        return run[end] - run[start]
+
+    def _advances(self, text):
+        """Returns an iterator over the advance widths of the characters."""
+        try:
+            codes = text.encode('ascii')
+        except UnicodeEncodeError:
+            # A dict probe per code point runs at C speed through map();
+            # a two-stage array table needs Python arithmetic per character
+            # and is over twice as slow without numpy
+            return map(self._get_cw().__getitem__, map(ord, text))
+        return map(self._get_ascii_cw().__getitem__, codes)
+
+    def _get_cw(self):
+        """Returns the width table of the font, loading it on first use."""
+        if self._cw is None:
+            font = self.pdf.fonts.get(self.font_family.lower() + self.font_style)
+            if isinstance(font, TTFFont):
+                # fpdf2 derives the advance widths from the font's cmap and
+                # hmtx tables when adding it, so the font need not be selected
+                self._cw = font.cw
+            else:
+                self._cw = self._with_font(_font_widths_by_code_point)
+        return self._cw
+
+    def _get_ascii_cw(self):
+        """Returns the ASCII width table, loading it on first use."""
+        if self._ascii_cw is None:
+            cw = self._get_cw()
+            self._ascii_cw = [cw[code] for code in range(128)]
+        return self._ascii_cw
+
+    def _check_text(self, text):
+        """Raises the error fpdf2 gives for text that the font lacks."""
+        # Only core fonts have characters missing from their width tables
+        self._with_font(lambda pdf: pdf.normalize_text(text))
+
+    def _with_font(self, function):
+        """Calls function(pdf) on pdf with this font selected."""
+        # Temporarily set the font to measure text, unless it already is
+        pdf = self.pdf
+        current_family = pdf.font_family
+        current_style = pdf.font_style
+        current_size = pdf.font_size_pt
+        needs_restore = current_family and (
+            current_family != self.font_family.lower()
+            or current_style != self.font_style
+            or current_size != self.font_size)
+
+        if needs_restore or not current_family:
+            pdf.set_font(self.font_family, self.font_style, self.font_size)
+        result = function(pdf)
+
+        # Restore previous font
+        if needs_restore:
+            pdf.set_font(current_family, current_style, current_size)
+
+        return result
+
+
+def _font_widths_by_code_point(pdf):
+    """Return the widths of the current font of pdf, keyed by code point.
+
+    Widths are in thousandths of the font size, as in fpdf2's tables.
+    """
+    font = pdf.current_font
+    # TrueType tables are keyed by code point, core font tables by the
+    # character of each byte of the core fonts encoding
+    if isinstance(font, TTFFont):
+        return font.cw
+    encoding = pdf.core_fonts_encoding
+    widths = {}
+    for char, width in font.cw.items():
+        if encoding:
+            try:
+                char = char.encode('latin-1').decode(encoding)
+            except UnicodeDecodeError:
+                # No character is encoded as this byte
+                continue
+        widths[ord(char)] = width
+    return widths
 
 
 class FpdfWriter:
-    """PDF writer using fpdf2 that matches the QtWriter interface."""
+    """PDF writer using fpdf2 that matches the QtWriter interface.
+
+    Text is buffered and written to the page in one text object when the
+    page is finished, so anything drawn directly on pdf in the meantime
+    (rectangles, images, ...) ends up underneath the text of the page.
+    """
 
     def __init__(self, path, width_pt, height_pt):
         """Initialize the PDF writer.
 
         Args:
-            path: Output PDF file path, or None to return PDF as bytes in close()
+            path: Output PDF file path, writable binary file object, or None
+                to return PDF as bytes in close()
             width_pt: Page width in points
             height_pt: Page height in points
         """
@@ -74,8 +227,8 @@ class FpdfWriter:
         self.height_pt = height_pt
 
         # Convert points to mm for fpdf2
-        self.width_mm = width_pt * MM_PER_INCH / POINTS_PER_INCH
-        self.height_mm = height_pt * MM_PER_INCH / POINTS_PER_INCH
+        self.width_mm = width_pt * MM_PER_PT
+        self.height_mm = height_pt * MM_PER_PT
 
         # Create PDF with custom page size
         self.pdf = FPDF(unit='pt', format=(width_pt, height_pt))
@@ -84,17 +237,40 @@ class FpdfWriter:
 
         # Track loaded fonts: path -> (family_name, style)
         self.loaded_fonts = {}
-        # Track font specifications: name -> FpdfFont
-        self.fonts = {}
+        # Track font specifications: name -> FpdfFont, without keeping
+        # fonts alive once the caller drops them
+        self.fonts = weakref.WeakValueDictionary()
+        # Shared font objects, least recently used first, by weak reference
+        # so that the fonts the caller dropped can be collected:
+        # (family, style, size) -> weakref to FpdfFont
+        self._font_pool = OrderedDict()
 
         self.current_font = None
+        # (family, style, size) last selected on pdf through set_font
+        self._active_font_key = None
+        # Text drawn on the current page but not yet written to it:
+        # list of (font, size_pt, paint, x_pt, y_pt, text), where paint is
+        # (text_color, text_mode, line_width) and text is a string, or for
+        # lines a TJ array of strings and position adjustments
+        self._pending_runs = []
+        # Line being built by add_glyph: (FpdfFont, y_pt,
+        # [(x_pt, text, normalized text)],
+        # (font, size_pt, paint)) with the last as the line is drawn in
+        self._line = None
 
     def close(self):
         """Save and close the PDF.
 
+        fpdf2 serializes the whole document into a single buffer.  When path
+        is None that buffer itself is returned, without a copy; otherwise it
+        is written to the file (or file object) in one call.
+
         Returns:
             bytearray or None: PDF content as bytearray if path was None, otherwise None
         """
+        if self._line is not None:
+            raise FPDFException("Line not ended, you need to call end_line() beforehand")
+        self._flush_runs()
         if self.path is None:
             return self.pdf.output()
         else:
@@ -107,31 +283,32 @@ class FpdfWriter:
         Args:
             path: Path to the .ttf font file
         """
-        path_obj = Path(path)
-        if not path_obj.exists():
+        # Normalized path, also used as the key of loaded_fonts
+        path_str = os.path.normpath(os.fspath(path))
+        if not os.path.isfile(path_str):
             raise FileNotFoundError(f"Font file not found: {path}")
 
+        # fpdf2 would parse the file again, only to discard it
+        if path_str in self.loaded_fonts:
+            return
+
         # Extract font info from filename
         # GenBasR.ttf -> Gentium Basic Regular
         # GenBasI.ttf -> Gentium Basic Italic
         # GenBasB.ttf -> Gentium Basic Bold
-        filename = path_obj.stem
+        filename = os.path.splitext(os.path.basename(path_str))[0]
 
-        # Determine style from filename
-        style = STYLE_REGULAR
-        if filename.endswith('I'):
-            style = STYLE_ITALIC
-        elif filename.endswith('B'):
-            style = STYLE_BOLD
-        elif filename.endswith('BI') or filename.endswith('IB'):
-            style = STYLE_BOLD_ITALIC
+        # Determine style from filename, trying two-letter suffixes first
+        style = STYLE_SUFFIXES.get(filename[-2:])
+        if style is None:
+            style = STYLE_SUFFIXES.get(filename[-1:], STYLE_REGULAR)
 
         # For Gentium Basic fonts, use a consistent family name
         family_name = DEFAULT_FONT_FAMILY
 
         # Add font to PDF
-        self.pdf.add_font(family_name, style, str(path_obj))
-        self.loaded_fonts[str(path_obj)] = (family_name, style)
+        self.pdf.add_font(family_name, style, path_str)
+        self.loaded_fonts[path_str] = (family_name, style)
 
     def get_fonts(self, font_specs):
         """Get font objects from specifications.
@@ -150,19 +327,53 @@ class FpdfWriter:
             fpdf_family = DEFAULT_FONT_FAMILY
 
             # Map style names to fpdf2 style codes
-            fpdf_style = STYLE_REGULAR
-            if 'Italic' in style:
-                fpdf_style = STYLE_ITALIC
-            elif 'Bold' in style:
-                fpdf_style = STYLE_BOLD
+            fpdf_style = STYLE_NAMES.get(style, STYLE_REGULAR)
+
+            # Names with the same font share one object, and so its widths
+            key = (fpdf_family, fpdf_style, round(size, FONT_SIZE_DECIMALS))
+            ref = self._font_pool.get(key)
+            font = ref() if ref is not None else None
+            if font is None:
+                font = FpdfFont(self.pdf, *key)
+                self._font_pool[key] = weakref.ref(font)
+                if len(self._font_pool) > MAX_POOLED_FONTS:
+                    self._font_pool.popitem(last=False)
+            self._font_pool.move_to_end(key)
+            fonts[name] = font
+
+        self.fonts.clear()
+        self.fonts.update(fonts)
+        return fonts
 
-            fonts[name] = FpdfFont(self.pdf, fpdf_family, fpdf_style, size)
+    def render_pages_parallel(self, page_callables, fonts, workers=None):
+        """Compute pages in worker processes, then draw them in order.
 
-        self.fonts = fonts
-        return fonts
+        Each page callable must be picklable (a module-level function, or a
+        functools.partial of one) and return the text runs of its page as
+        (font_name, x_pt, y_pt, text) tuples, where font_name is a key of
+        fonts.  The first page is drawn on the current page, and each
+        following one on a new page.
+
+        Args:
+            page_callables: Sequence of callables, one per page
+            fonts: Dictionary mapping font names to FpdfFont objects, as
+                returned by get_fonts
+            workers: Number of worker processes, defaults to os.cpu_count()
+        """
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            pages = executor.map(_call_page, page_callables)
+            for i, runs in enumerate(pages):
+                if i:
+                    self.new_page()
+                for font_name, x_pt, y_pt, text in runs:
+                    self.set_font(fonts[font_name])
+                    self.draw_text(x_pt, y_pt, text)
 
     def new_page(self):
         """Create a new page."""
+        if self._line is not None:
+            raise FPDFException("Line not ended, you need to call end_line() beforehand")
+        self._flush_runs()
         self.pdf.add_page()
 
     def set_font(self, font):
@@ -172,7 +383,12 @@ class FpdfWriter:
             font: An FpdfFont object
         """
         self.current_font = font
-        self.pdf.set_font(font.font_family, font.font_style, font.font_size)
+        # Measuring never changes the font of pdf, so the selection made
+        # by the last call is still in effect
+        key = (font.font_family, font.font_style, font.font_size)
+        if key != self._active_font_key:
+            self.pdf.set_font(*key)
+            self._active_font_key = key
 
     def draw_text(self, x_pt, y_pt, text):
         """Draw text at specified coordinates.
@@ -185,4 +401,172 @@ class FpdfWriter:
         # fpdf2 uses top-left origin, same as Qt
         # The y coordinate in the typesetting system appears to be baseline
         # We need to draw at the position
-        self.pdf.text(x_pt, y_pt, text)
\ No newline at end of file
+        # The run is buffered and written with the rest of the page
+        pdf = self.pdf
+        if not pdf.font_family:
+            raise FPDFException("No font set, you need to call set_font() beforehand")
+        if pdf.underline or pdf.strikethrough:
+            # Decorations are lines drawn by fpdf2 along with the text
+            self._flush_runs()
+            pdf.text(x_pt, y_pt, text)
+            return
+        self._pending_runs.append((pdf.current_font, pdf.font_size_pt,
+                                   _paint(pdf), x_pt, y_pt,
+                                   pdf.normalize_text(text)))
+
+    def begin_line(self, y_pt, font):
+        """Start a line of text drawn in a single font.
+
+        The pieces added with add_glyph are written as one TJ array, with
+        the space between them expressed as position adjustments, instead
+        of one positioned run each.
+
+        Args:
+            y_pt: Y coordinate of the baseline in points
+            font: An FpdfFont object, which becomes the current font
+        """
+        if self._line is not None:
+            raise FPDFException("Line not ended, you need to call end_line() beforehand")
+        self.set_font(font)
+        pdf = self.pdf
+        self._line = (font, y_pt, [],
+                      (pdf.current_font, pdf.font_size_pt, _paint(pdf)))
+
+    def add_glyph(self, x_pt, text):
+        """Add text to the current line.
+
+        Args:
+            x_pt: X coordinate in points, at or after the end of the
+                previous piece of the line
+            text: Text string to draw
+        """
+        if self._line is None:
+            raise FPDFException("No line started, you need to call begin_line() beforehand")
+        # The font of pdf may have changed since begin_line
+        pdf_font = self._line[3][0]
+        self._line[2].append(
+            (x_pt, text, _normalize_text(self.pdf, pdf_font, text)))
+
+    def end_line(self):
+        """Finish the current line and queue it for drawing."""
+        if self._line is None:
+            raise FPDFException("No line started, you need to call begin_line() beforehand")
+        font, y_pt, pieces, (pdf_font, size_pt, paint) = self._line
+        self._line = None
+        if not pieces:
+            return
+
+        # A TJ number moves the next glyph left by thousandths of the size
+        scale = 1000 / font.font_size
+        array = []
+        x_end = pieces[0][0]
+        for x_pt, text, normalized in pieces:
+            adjustment = round((x_end - x_pt) * scale, 2)
+            if adjustment:
+                array.append(adjustment)
+            # Widths are measured on text, encoding works on normalized text
+            array.append(normalized)
+            x_end = x_pt + font.width_of(text)
+
+        self._pending_runs.append((pdf_font, size_pt, paint,
+                                   pieces[0][0], y_pt, array))
+
+    def _flush_runs(self):
+        """Write the pending text runs of the page as a single text object.
+
+        Unlike FPDF.text(), which opens a text object per call, this selects
+        a font only when it changes between runs and moves between runs with
+        relative Td offsets.  Text colour and rendering mode are likewise
+        set when they change, and the graphics state is saved around the
+        text object if they are.  Runs keep their drawing order.
+        """
+        if not self._pending_runs:
+            return
+
+        pdf = self.pdf
+        operators = ['BT']
+        current = None
+        # Text is painted with the fill colour, as FPDF.text() assumes
+        current_paint = (pdf.fill_color, TextMode.FILL, None)
+        painted = False
+        last_x = last_y = 0
+        for font, size_pt, paint, x_pt, y_pt, text in self._pending_runs:
+            if (font, size_pt) != current:
+                operators.append(pdf._set_font_for_page(
+                    font, size_pt, wrap_in_text_object=False))
+                current = (font, size_pt)
+            if paint != current_paint:
+                operators.extend(_paint_operators(current_paint, paint))
+                current_paint = paint
+                painted = True
+            # PDF user space has its origin at the bottom-left corner
+            x = round(x_pt * pdf.k, 2)
+            y = round((pdf.h - y_pt) * pdf.k, 2)
+            operators.append(f'{x - last_x:.2f} {y - last_y:.2f} Td')
+            if isinstance(text, str):
+                operators.append(font.encode_text(text))
+            else:
+                operators.append(_encode_tj_array(font, text))
+            last_x, last_y = x, y
+        operators.append('ET')
+        if painted:
+            operators = ['q', *operators, 'Q']
+
+        pdf._out(' '.join(operators))
+        self._pending_runs = []
+        # The font last selected in the text object may not be pdf's
+        pdf.current_font_is_set_on_page = False
+
+
+def _call_page(page_callable):
+    """Run a page callable in a worker process and collect its text runs."""
+    return list(page_callable())
+
+
+def _normalize_text(pdf, font, text):
+    """Return text as FPDF.normalize_text() does with font selected."""
+    # Only core fonts need their text encoded
+    encoding = pdf.core_fonts_encoding
+    if isinstance(font, TTFFont) or not encoding:
+        return text
+    try:
+        return text.encode(encoding).decode('latin-1')
+    except UnicodeEncodeError as error:
+        raise FPDFUnicodeEncodingException(
+            text_index=error.start,
+            character=text[error.start],
+            font_name=font.fontkey,
+        ) from error
+
+
+def _paint(pdf):
+    """Return how pdf paints text: (text_color, text_mode, line_width)."""
+    mode = pdf.text_mode
+    # The line width only matters to the modes that stroke glyph outlines
+    line_width = None if mode == TextMode.FILL else pdf.line_width
+    return (pdf.text_color, mode, line_width)
+
+
+def _paint_operators(previous, paint):
+    """Return the operators switching text painting from previous to paint."""
+    color, mode, line_width = paint
+    operators = []
+    if color != previous[0]:
+        operators.append(color.serialize().lower())
+    if (mode, line_width) != previous[1:]:
+        operators.append(f'{mode} Tr')
+        if line_width is not None:
+            operators.append(f'{line_width:.2f} w')
+    return operators
+
+
+def _encode_tj_array(font, array):
+    """Return the TJ operator showing an array of strings and adjustments."""
+    elements = []
+    for element in array:
+        if isinstance(element, str):
+            # fpdf2 only encodes strings as complete Tj operators
+            elements.append(font.encode_text(element).removesuffix(' Tj'))
+        else:
+            elements.append(f'{element:.2f}')
+    return f"[{' '.join(elements)}] TJ"
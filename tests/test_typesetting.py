@@ -1,10 +1,18 @@
 
+import os
+
+import pytest
+from fpdf import FPDF
+
 from pykerning.composing import (
     avoid_widows_and_orphans, run, section_break, section_title,
 )
 from pykerning.skeleton import (
     Column, Font, Line, Page, single_column_layout, unroll,
 )
+from pykerning.knuth import _range_measure, break_text_into_boxes
+from pykerning.vendored.texlib_wrap import Glue
+from pykerning.writer_fpdf import FpdfFont
 
 next_line = single_column_layout(10, 34, 0, 0, 0, 0)
 
@@ -343,6 +351,33 @@ def _run(*actions):
     lines = unroll(None, line)[1:]
     return [(line.column.id, line.y, line.graphics) for line in lines]
 
+def test_break_text_into_boxes_range_measure():
+    # Measuring each box as a range of the whole text gives the boxes
+    # that measuring its string does.
+    font_path = 'examples/steam/fonts/GenBasR.ttf'
+    if not os.path.exists(font_path):
+        pytest.skip("Font file not available for testing")
+    pdf = FPDF(unit='pt')
+    pdf.add_font('GentiumBasic', '', font_path)
+    font = FpdfFont(pdf, 'GentiumBasic', '', 12)
+    text = ('Hyphenation, typesetting—and well-known words: '
+            'Mr.\u00a0Rhodes wrote (everything) extraordinarily.')
+    glue = Glue(3, 1, 1)
+
+    def boxes(measure):
+        return [(type(item).__name__, getattr(item, 'content', None),
+                 item.width)
+                for item in break_text_into_boxes(
+                    text, 'roman', font.width_of, glue, measure)]
+
+    expected = boxes(None)
+    actual = boxes(_range_measure(font, text))
+
+    assert any(content == ('roman', 'Hy') for _, content, _ in expected)
+    assert [item[:2] for item in actual] == [item[:2] for item in expected]
+    assert [item[2] for item in actual] == \
+        pytest.approx([item[2] for item in expected])
+
 def _debug(line):
     lines = unroll(None, line)[1:]
     for i, line in enumerate(lines, 1):
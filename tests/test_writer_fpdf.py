@@ -3,12 +3,23 @@
 import pytest
 from pathlib import Path
 import tempfile
+import io
+import functools
+import gc
+import weakref
 import os
 from fpdf import FPDF
+from fpdf.errors import FPDFException, FPDFUnicodeEncodingException
 
 from pykerning.writer_fpdf import FpdfWriter, FpdfFont
 
 
+def _numbered_page(number):
+    """Page callable for render_pages_parallel tests."""
+    return [('roman', 100 + number, 100, f'Page {number}'),
+            ('title', 100, 200, 'Title')]
+
+
 class TestFpdfFont:
     """Tests for the FpdfFont class."""
 
@@ -31,6 +42,12 @@ class TestFpdfFont:
         assert font.font_size == 12
         assert font.height == 12
 
+    def test_no_instance_dict(self, font):
+        """Test that FpdfFont declares its attributes in __slots__."""
+        assert not hasattr(font, '__dict__')
+        with pytest.raises(AttributeError):
+            font.color = 'red'
+
     def test_font_metrics(self, font):
         """Test that font metrics are calculated correctly."""
         assert font.height == 12
@@ -85,6 +102,95 @@ class TestFpdfFont:
         assert pdf.font_family == 'helvetica'
         assert pdf.font_size_pt == 10
 
+    def test_width_of_same_font_skips_set_font(self, pdf, monkeypatch):
+        """Test that measuring in the document's current font keeps it."""
+        pdf.set_font('Helvetica', '', 12)
+        font = FpdfFont(pdf, 'Helvetica', '', 12)
+
+        calls = []
+        monkeypatch.setattr(pdf, 'set_font', lambda *args: calls.append(args))
+        assert font.width_of('Test') > 0
+        assert calls == []
+
+    def test_width_of_is_cached(self, pdf):
+        """Test that repeated width_of calls do not measure again."""
+        pdf.add_page()
+        font = FpdfFont(pdf, 'Helvetica', '', 12)
+
+        width = font.width_of('Hello')
+        pdf.set_font('Helvetica', '', 12)
+        assert width == pdf.get_string_width('Hello')
+
+        font._width_cache['Hello'] = -1
+        assert font.width_of('Hello') == -1
+
+    def test_width_of_ascii_matches_fpdf(self, pdf):
+        """Test that the ASCII width table agrees with fpdf2."""
+        font = FpdfFont(pdf, 'Times', 'I', 11.5)
+        text = 'The quick brown fox, 0-9 ~!'
+
+        pdf.set_font('Times', 'I', 11.5)
+        assert font.width_of(text) == pdf.get_string_width(text)
+        assert len(font._ascii_cw) == 128
+
+    def test_width_of_non_ascii(self, pdf):
+        """Test that non-ASCII text widths agree with fpdf2."""
+        font = FpdfFont(pdf, 'Helvetica', '', 12)
+
+        pdf.set_font('Helvetica', '', 12)
+        assert font.width_of('café') == pdf.get_string_width('café')
+        assert font._ascii_cw is None
+
+    def test_width_of_core_font_encoding(self, pdf):
+        """Test that core fonts measure characters as fpdf2 encodes them."""
+        pdf.core_fonts_encoding = 'windows-1252'
+        font = FpdfFont(pdf, 'Helvetica', '', 12)
+
+        pdf.set_font('Helvetica', '', 12)
+        assert font.width_of('€1') == pdf.get_string_width('€1')
+        assert font.prepare_run('€1')[-1] == pytest.approx(font.width_of('€1'))
+
+    def test_width_of_core_font_unsupported(self, pdf):
+        """Test that core fonts reject characters they lack, like fpdf2."""
+        font = FpdfFont(pdf, 'Helvetica', '', 12)
+
+        with pytest.raises(FPDFUnicodeEncodingException):
+            font.width_of('→')
+        with pytest.raises(FPDFUnicodeEncodingException):
+            font.prepare_run('→')
+
+    def test_width_of_non_ascii_ttf(self, pdf):
+        """Test that non-ASCII TrueType widths agree with fpdf2."""
+        font_path = 'examples/steam/fonts/GenBasR.ttf'
+        if not os.path.exists(font_path):
+            pytest.skip("Font file not available for testing")
+        pdf.add_font('GentiumBasic', '', font_path)
+        font = FpdfFont(pdf, 'GentiumBasic', '', 12)
+        text = 'Déjà vu \u2014 \u201cquoted\u201d'
+
+        pdf.set_font('GentiumBasic', '', 12)
+        assert font.width_of(text) == pdf.get_string_width(text)
+
+    def test_width_of_range(self, font):
+        """Test that ranges of a prepared run match width_of."""
+        text = 'Hello brave new world'
+        run = font.prepare_run(text)
+
+        assert len(run) == len(text) + 1
+        assert run[0] == 0
+        assert font.width_of_range(run, 6, 11) == \
+            pytest.approx(font.width_of('brave'))
+        assert font.width_of_range(run, 0, len(text)) == \
+            pytest.approx(font.width_of(text))
+
+    def test_width_of_range_non_ascii(self, font):
+        """Test prepared runs of non-ASCII text."""
+        text = 'déjà vu'
+        run = font.prepare_run(text)
+
+        assert font.width_of_range(run, 0, 4) == \
+            pytest.approx(font.width_of('déjà'))
+
 
 class TestFpdfWriter:
     """Tests for the FpdfWriter class."""
@@ -133,6 +239,20 @@ class TestFpdfWriter:
         assert os.path.exists(temp_pdf_path)
         assert os.path.getsize(temp_pdf_path) > 0
 
+    def test_close_writes_file_object(self):
+        """Test that close() writes to a binary file object."""
+        stream = io.BytesIO()
+        writer = FpdfWriter(stream, 612, 792)
+
+        assert writer.close() is None
+        assert stream.getvalue().startswith(b'%PDF')
+
+    def test_close_returns_pdf_buffer(self, writer):
+        """Test that close() returns fpdf2's buffer without copying it."""
+        pdf_bytes = writer.close()
+
+        assert pdf_bytes is writer.pdf.buffer
+
     def test_load_font_nonexistent_file(self, writer):
         """Test that load_font raises FileNotFoundError for nonexistent file."""
         with pytest.raises(FileNotFoundError, match="Font file not found"):
@@ -172,6 +292,47 @@ class TestFpdfWriter:
         else:
             pytest.skip("Font file not available for testing")
 
+    def test_load_font_normalizes_path(self, writer):
+        """Test that equivalent spellings of a path load the font once."""
+        font_path = 'examples/steam/fonts/GenBasR.ttf'
+        if not os.path.exists(font_path):
+            pytest.skip("Font file not available for testing")
+        writer.load_font(font_path)
+        writer.load_font('./examples/steam/../steam/fonts/GenBasR.ttf')
+
+        assert list(writer.loaded_fonts) == [os.path.normpath(font_path)]
+
+    def test_load_font_directory(self, writer, tmp_path):
+        """Test that load_font rejects a directory."""
+        with pytest.raises(FileNotFoundError, match="Font file not found"):
+            writer.load_font(tmp_path)
+
+    def test_load_font_twice(self, writer, recwarn):
+        """Test that loading a font file again does nothing."""
+        font_path = 'examples/steam/fonts/GenBasR.ttf'
+        if not os.path.exists(font_path):
+            pytest.skip("Font file not available for testing")
+        writer.load_font(font_path)
+        font = writer.pdf.fonts['gentiumbasic']
+        writer.load_font(font_path)
+
+        assert writer.pdf.fonts['gentiumbasic'] is font
+        assert len(recwarn) == 0
+
+    def test_load_font_bold_italic(self, tmp_path):
+        """Test loading a bold italic font."""
+        font_path = 'examples/steam/fonts/GenBasB.ttf'
+        if not os.path.exists(font_path):
+            pytest.skip("Font file not available for testing")
+        for name in 'GenBasBI.ttf', 'GenBasIB.ttf':
+            copy_path = tmp_path / name
+            copy_path.write_bytes(Path(font_path).read_bytes())
+            writer = FpdfWriter(None, 612, 792)
+            writer.load_font(copy_path)
+            family, style = writer.loaded_fonts[str(copy_path)]
+            assert family == 'GentiumBasic'
+            assert style == 'BI'
+
     def test_get_fonts(self, writer):
         """Test get_fonts method."""
         font_specs = [
@@ -198,6 +359,19 @@ class TestFpdfWriter:
 
         assert writer.fonts == fonts
 
+    def test_get_fonts_does_not_keep_fonts_alive(self, writer):
+        """Test that the writer only holds weak references to fonts."""
+        fonts = writer.get_fonts([('roman', 'Gentium Basic', 'Regular', 12)])
+        font = weakref.ref(fonts['roman'])
+
+        del fonts
+        gc.collect()
+
+        assert font() is None
+        assert len(writer.fonts) == 0
+        again = writer.get_fonts([('roman', 'Gentium Basic', 'Regular', 12)])
+        assert again['roman'].font_size == 12
+
     def test_get_fonts_style_mapping(self, writer):
         """Test that font styles are mapped correctly."""
         font_specs = [
@@ -212,6 +386,83 @@ class TestFpdfWriter:
         assert fonts['italic'].font_style == 'I'
         assert fonts['bold'].font_style == 'B'
 
+    def test_get_fonts_shares_identical_fonts(self, writer):
+        """Test that names for the same font share one FpdfFont."""
+        font_specs = [
+            ('roman', 'Gentium Basic', 'Regular', 12),
+            ('body', 'Gentium Basic', 'Regular', 12),
+            ('title', 'Gentium Basic', 'Regular', 24),
+        ]
+
+        fonts = writer.get_fonts(font_specs)
+        again = writer.get_fonts(font_specs[:1])
+
+        assert fonts['roman'] is fonts['body']
+        assert fonts['roman'] is not fonts['title']
+        assert again['roman'] is fonts['roman']
+
+    def test_get_fonts_rounds_sizes(self, writer):
+        """Test that sizes differing by float noise share one font."""
+        fonts = writer.get_fonts([
+            ('roman', 'Gentium Basic', 'Regular', 12),
+            ('converted', 'Gentium Basic', 'Regular', 12.000000001),
+        ])
+
+        assert fonts['roman'] is fonts['converted']
+        assert fonts['converted'].font_size == 12
+
+    def test_get_fonts_pool_is_bounded(self, writer):
+        """Test that the least recently used fonts leave the pool."""
+        first = writer.get_fonts([('roman', 'Gentium Basic', 'Regular', 1)])
+        for size in range(2, 100):
+            writer.get_fonts([('roman', 'Gentium Basic', 'Regular', size)])
+
+        assert len(writer._font_pool) == 64
+        again = writer.get_fonts([('roman', 'Gentium Basic', 'Regular', 1)])
+        assert again['roman'] is not first['roman']
+
+    def test_get_fonts_measure_without_touching_pdf(self, writer):
+        """Test that measuring writer fonts leaves the output font unset."""
+        font_path = 'examples/steam/fonts/GenBasR.ttf'
+        if not os.path.exists(font_path):
+            pytest.skip("Font file not available for testing")
+        writer.load_font(font_path)
+        fonts = writer.get_fonts([('roman', 'Gentium Basic', 'Regular', 12)])
+
+        assert fonts['roman'].width_of('Hello') > 0
+        assert writer.pdf.font_family == ''
+
+    def test_get_fonts_measure_font_added_to_pdf(self, writer):
+        """Test that fonts added to pdf directly can be measured."""
+        font_path = 'examples/steam/fonts/GenBasR.ttf'
+        if not os.path.exists(font_path):
+            pytest.skip("Font file not available for testing")
+        writer.pdf.add_font('GentiumBasic', '', font_path)
+        fonts = writer.get_fonts([('roman', 'Gentium Basic', 'Regular', 12)])
+
+        writer.pdf.set_font('GentiumBasic', '', 12)
+        assert fonts['roman'].width_of('Hello') == \
+            writer.pdf.get_string_width('Hello')
+
+    def test_get_fonts_measure_font_not_loaded(self, writer):
+        """Test that measuring a font that was never loaded fails."""
+        fonts = writer.get_fonts([('roman', 'Gentium Basic', 'Regular', 12)])
+
+        with pytest.raises(FPDFException, match="Undefined font"):
+            fonts['roman'].width_of('Hello')
+
+    def test_get_fonts_measure_font_loaded_later(self, writer):
+        """Test that fonts loaded after get_fonts can still be measured."""
+        font_path = 'examples/steam/fonts/GenBasR.ttf'
+        if not os.path.exists(font_path):
+            pytest.skip("Font file not available for testing")
+        fonts = writer.get_fonts([('roman', 'Gentium Basic', 'Regular', 12)])
+        writer.load_font(font_path)
+
+        writer.pdf.set_font('GentiumBasic', '', 12)
+        assert fonts['roman'].width_of('Hello') == \
+            writer.pdf.get_string_width('Hello')
+
     def test_new_page(self, writer):
         """Test new_page method."""
         initial_page_count = writer.pdf.page
@@ -227,6 +478,21 @@ class TestFpdfWriter:
         assert writer.pdf.font_family == 'helvetica'
         assert writer.pdf.font_size_pt == 12
 
+    def test_set_font_skips_same_font(self, writer, monkeypatch):
+        """Test that selecting the active font again does not call fpdf2."""
+        writer.set_font(FpdfFont(writer.pdf, 'Helvetica', '', 12))
+
+        calls = []
+        monkeypatch.setattr(writer.pdf, 'set_font',
+                            lambda *args: calls.append(args))
+        same = FpdfFont(writer.pdf, 'Helvetica', '', 12)
+        writer.set_font(same)
+        assert writer.current_font is same
+        assert calls == []
+
+        writer.set_font(FpdfFont(writer.pdf, 'Helvetica', 'B', 12))
+        assert calls == [('Helvetica', 'B', 12)]
+
     def test_draw_text(self, writer):
         """Test draw_text method."""
         # Set up a font first
@@ -235,6 +501,148 @@ class TestFpdfWriter:
         # This should not raise an exception
         writer.draw_text(100, 100, 'Test text')
 
+    def test_draw_text_without_font(self, writer):
+        """Test that draw_text requires a font, like FPDF.text()."""
+        with pytest.raises(FPDFException, match="No font set"):
+            writer.draw_text(100, 100, 'Test text')
+
+    def test_draw_text_single_text_object(self, writer):
+        """Test that the runs of a page are written as one text object."""
+        writer.set_font(FpdfFont(writer.pdf, 'Helvetica', '', 12))
+        writer.draw_text(100, 100, 'Hello')
+        writer.draw_text(150, 100, 'World')
+        writer.set_font(FpdfFont(writer.pdf, 'Times', 'B', 14))
+        writer.draw_text(100, 120, 'Again')
+        writer.new_page()
+
+        contents = bytes(writer.pdf.pages[1].contents)
+        assert contents.count(b'BT') == 1
+        assert contents.count(b' Tf') == 2
+        assert b'100.00 692.00 Td (Hello) Tj 50.00 0.00 Td (World) Tj' \
+            in contents
+        assert b'-50.00 -20.00 Td (Again) Tj ET' in contents
+
+    def test_draw_text_color(self, writer):
+        """Test that runs keep the text colour they were drawn with."""
+        writer.set_font(FpdfFont(writer.pdf, 'Helvetica', '', 12))
+        writer.pdf.set_text_color(255, 0, 0)
+        writer.draw_text(100, 100, 'Red')
+        writer.pdf.set_text_color(0)
+        writer.draw_text(150, 100, 'Black')
+        writer.new_page()
+
+        contents = bytes(writer.pdf.pages[1].contents)
+        assert b'q BT' in contents
+        assert b'1 0 0 rg 100.00 692.00 Td (Red) Tj' in contents
+        assert b'0 g 50.00 0.00 Td (Black) Tj ET Q' in contents
+
+    def test_draw_text_underline(self, writer):
+        """Test that underlined text is drawn by fpdf2, in order."""
+        writer.set_font(FpdfFont(writer.pdf, 'Helvetica', '', 12))
+        writer.draw_text(100, 100, 'Plain')
+        writer.pdf.set_font(style='U')
+        writer.draw_text(100, 120, 'Underlined')
+
+        contents = bytes(writer.pdf.pages[1].contents)
+        assert contents.index(b'(Plain) Tj') < contents.index(b'(Underlined) Tj')
+        assert b' re f' in contents
+        assert writer._pending_runs == []
+
+    def test_line_single_tj_array(self, writer):
+        """Test that a line is written as one TJ array with adjustments."""
+        font = FpdfFont(writer.pdf, 'Helvetica', '', 10)
+        writer.begin_line(100, font)
+        writer.add_glyph(100, 'Hello')
+        writer.add_glyph(100 + font.width_of('Hello'), 'World')
+        writer.add_glyph(200, 'Again')
+        writer.end_line()
+        writer.new_page()
+
+        gap = 200 - 100 - font.width_of('HelloWorld')
+        contents = bytes(writer.pdf.pages[1].contents)
+        assert contents.count(b'BT') == 1
+        assert contents.count(b'TJ') == 1
+        assert (b'100.00 692.00 Td [(Hello) (World) %.2f (Again)] TJ'
+                % (-gap * 100)) in contents
+        assert writer.current_font is font
+
+    def test_line_core_font_encoding(self, writer):
+        """Test lines of core font text that fpdf2 encodes as cp1252."""
+        writer.pdf.core_fonts_encoding = 'windows-1252'
+        font = FpdfFont(writer.pdf, 'Helvetica', '', 10)
+        writer.begin_line(100, font)
+        writer.add_glyph(100, '\u201cHi\u201d')
+        writer.add_glyph(150, 'there')
+        writer.end_line()
+        writer.new_page()
+
+        gap = 150 - 100 - font.width_of('\u201cHi\u201d')
+        contents = bytes(writer.pdf.pages[1].contents)
+        assert (b'[(\x93Hi\x94) %.2f (there)] TJ' % (-gap * 100)) in contents
+
+    def test_line_font_changed(self, writer):
+        """Test that a line is drawn in its font, even if another is set."""
+        font = FpdfFont(writer.pdf, 'Helvetica', '', 10)
+        writer.begin_line(100, font)
+        writer.add_glyph(100, 'Hello')
+        writer.set_font(FpdfFont(writer.pdf, 'Times', 'B', 20))
+        writer.draw_text(100, 50, 'Header')
+        writer.add_glyph(200, 'World')
+        writer.end_line()
+        writer.new_page()
+
+        gap = 200 - 100 - font.width_of('Hello')
+        contents = bytes(writer.pdf.pages[1].contents)
+        assert b'/F2 20.00 Tf 100.00 742.00 Td (Header) Tj' in contents
+        assert (b'/F1 10.00 Tf 0.00 -50.00 Td [(Hello) %.2f (World)] TJ'
+                % (-gap * 100)) in contents
+
+    def test_line_font_changed_skips_set_font(self, writer, monkeypatch):
+        """Test that add_glyph leaves the font of pdf alone."""
+        writer.begin_line(100, FpdfFont(writer.pdf, 'Helvetica', '', 10))
+        writer.set_font(FpdfFont(writer.pdf, 'Times', 'B', 20))
+        calls = []
+        monkeypatch.setattr(writer.pdf, 'set_font',
+                            lambda *args: calls.append(args))
+
+        writer.add_glyph(100, 'Hello')
+
+        assert calls == []
+        with pytest.raises(FPDFUnicodeEncodingException):
+            writer.add_glyph(150, '→')
+
+    def test_line_without_glyphs(self, writer):
+        """Test that an empty line draws nothing."""
+        writer.begin_line(100, FpdfFont(writer.pdf, 'Helvetica', '', 10))
+        writer.end_line()
+
+        assert writer._pending_runs == []
+
+    def test_line_not_started(self, writer):
+        """Test that add_glyph and end_line require begin_line."""
+        with pytest.raises(FPDFException, match="No line started"):
+            writer.add_glyph(100, 'Hello')
+        with pytest.raises(FPDFException, match="No line started"):
+            writer.end_line()
+
+    def test_line_not_ended(self, writer):
+        """Test that an open line must be ended before moving on."""
+        font = FpdfFont(writer.pdf, 'Helvetica', '', 10)
+        writer.begin_line(100, font)
+        writer.add_glyph(100, 'Hello')
+
+        with pytest.raises(FPDFException, match="Line not ended"):
+            writer.begin_line(120, font)
+        with pytest.raises(FPDFException, match="Line not ended"):
+            writer.new_page()
+        with pytest.raises(FPDFException, match="Line not ended"):
+            writer.close()
+        assert writer.pdf.pages_count == 1
+
+        writer.end_line()
+        writer.new_page()
+        assert b'[(Hello)] TJ' in bytes(writer.pdf.pages[1].contents)
+
     def test_integration_create_simple_pdf(self):
         """Integration test: Create a simple PDF with text."""
         writer = FpdfWriter(None, 612, 792)
@@ -252,6 +660,30 @@ class TestFpdfWriter:
         assert isinstance(pdf_bytes, (bytes, bytearray))
         assert len(pdf_bytes) > 0
 
+    def test_render_pages_parallel(self, writer):
+        """Test that pages computed by workers are drawn in order."""
+        font_path = 'examples/steam/fonts/GenBasR.ttf'
+        if not os.path.exists(font_path):
+            pytest.skip("Font file not available for testing")
+        writer.load_font(font_path)
+        fonts = writer.get_fonts([
+            ('roman', 'Gentium Basic', 'Regular', 12),
+            ('title', 'Gentium Basic', 'Regular', 24),
+        ])
+
+        pages = [functools.partial(_numbered_page, n) for n in range(3)]
+        writer.render_pages_parallel(pages, fonts, workers=2)
+        writer.new_page()
+
+        assert writer.pdf.pages_count == 4
+        font = writer.pdf.fonts['gentiumbasic']
+        for n in range(3):
+            contents = bytes(writer.pdf.pages[n + 1].contents)
+            text = font.encode_text(f'Page {n}').encode('latin-1')
+            assert b'%d.00 692.00 Td %s' % (100 + n, text) in contents
+            assert contents.count(b' Tf') == 2
+        assert writer.close().startswith(b'%PDF')
+
     def test_integration_multiple_pages(self):
         """Integration test: Create a PDF with multiple pages."""
         writer = FpdfWriter(None, 612, 792)